@@ -3,33 +3,20 @@
 
 import os
 import io
-import regex as re
+import collections
+import functools
+import itertools
+import multiprocessing
+import regex
 import unidecode
 from tqdm import tqdm
 
 
-# Character simplification, based on Unidecode
+# Character simplification, based on Unidecode (surrogates are silently dropped)
 def unidecode_char(char):
-    codepoint = ord(char)
-    if codepoint < 0x80:
-        return char
-    if codepoint > 0xeffff:
+    if 0xd800 <= ord(char) <= 0xdfff:
         return ''
-    if 0xd800 <= codepoint and codepoint <= 0xdfff:
-        return ''
-    section = codepoint >> 8
-    position = codepoint % 256
-    try:
-        table = unidecode.Cache[section]
-    except KeyError:
-        try:
-            mod = __import__('unidecode.x%03x' % section, globals(), locals(), ['data'])
-            unidecode.Cache[section] = table = mod.data
-        except ImportError:
-            unidecode.Cache[section] = table = None
-    if table and len(table) > position:
-        return table[position]
-    return ''
+    return unidecode.unidecode(char)
 
 
 # Replace Unidecode's behavior for some special characters
@@ -107,6 +94,9 @@ NORMALIZED_OVERRIDDEN_CHARACTERS = {
     # TODO other European languages
 }
 
+# Same overrides, keyed by codepoint
+NORMALIZED_OVERRIDDEN_CODEPOINTS = {ord(k) : v for k, v in NORMALIZED_OVERRIDDEN_CHARACTERS.items()}
+
 # Apply mapping to Unidecoded characters
 NORMALIZED_MAPPED_CHARACTERS = [
     '',   #   0 - NUL
@@ -240,69 +230,142 @@ NORMALIZED_MAPPED_CHARACTERS = [
 ]
 
 
-# Normalized character set
-NORMALIZED_CHARACTERS = sorted(set(NORMALIZED_MAPPED_CHARACTERS).union(set(NORMALIZED_OVERRIDDEN_CHARACTERS.values())))
+# Normalized character set, computed on demand
+@functools.lru_cache(maxsize=None)
+def normalized_characters():
+    return sorted(set(NORMALIZED_MAPPED_CHARACTERS).union(set(NORMALIZED_OVERRIDDEN_CHARACTERS.values())))
+
+
+# Translation table for normalization, lazily populated as new characters are encountered
+# Special rules for common symbols and diacritics used in European languages are included from the start
+class NormalizedTable(dict):
+    def __missing__(self, codepoint):
+        normalized = ''.join([NORMALIZED_MAPPED_CHARACTERS[ord(c)] for c in unidecode_char(chr(codepoint))])
+        self[codepoint] = normalized
+        return normalized
+NORMALIZED_TABLE = NormalizedTable(NORMALIZED_OVERRIDDEN_CODEPOINTS)
+
+
+# Byte translation tables for pure ASCII text, which does not require Unidecode
+NORMALIZED_ASCII_TABLE = bytes(ord(c) if len(c) == 1 else i for i, c in enumerate(NORMALIZED_MAPPED_CHARACTERS)) + bytes(range(128, 256))
+NORMALIZED_ASCII_DELETED = bytes(i for i, c in enumerate(NORMALIZED_MAPPED_CHARACTERS) if len(c) == 0)
 
 
-# Character simplification, with special rules for common symbols and diacritics used in European languages
+# Character simplification, memoized by codepoint
 def normalize_char(char):
-    if char in NORMALIZED_OVERRIDDEN_CHARACTERS:
-        return NORMALIZED_OVERRIDDEN_CHARACTERS[char]
-    return ''.join([NORMALIZED_MAPPED_CHARACTERS[ord(c)] for c in unidecode_char(char)])
+    return NORMALIZED_TABLE[ord(char)]
 
 
-# Replace rare/non-latin characters by simplified/latin representation
-_whitespace = re.compile('\s+', re.UNICODE)
+# Replace rare/non-latin characters by simplified/latin representation, and collapse whitespaces
 def normalize(text):
-    result = []
-    for char in text:
-        for c in normalize_char(char):
-            result.append(c)
-    result = ''.join(result)
-    result = _whitespace.sub(' ', result)
-    result = result.strip()
-    return result
+    if text.isascii():
+        result = text.encode('ascii').translate(NORMALIZED_ASCII_TABLE, NORMALIZED_ASCII_DELETED).decode('ascii')
+    else:
+        result = text.translate(NORMALIZED_TABLE)
+    return ' '.join(result.split())
 
 
 # Use simple rules to tokenize text
-_token = re.compile(r'\s*((?:\p{L}|\d)+|.)', re.UNICODE)
+_token = regex.compile(r'\s*((?:\p{L}|\d)+|.)', regex.UNICODE)
 def tokenize(text):
-    pos = 0
-    while True:
-        match = _token.match(text, pos)
-        if not match:
-            break
+    for match in _token.finditer(text):
         yield match.group(1)
-        pos = match.end(1)
 
 
 # Simplify tokens
-_digits = re.compile(r'\d+', re.UNICODE)
+_digits = regex.compile(r'\d+', regex.UNICODE)
 def simplify(token):
     token = token.lower()
     token = _digits.sub('0', token)
     return token
 
 
+# Tokenize and simplify text in a single pass, equivalent to simplify(tokenize(...))
+_simplified_token = regex.compile(r'\s*(?:(\d++)(?!\p{L})|(\p{L}++)(?!\d)|((?:\p{L}|\d)+)|(.))', regex.UNICODE)
+def tokenize_simplified(text):
+    for digits, letters, mixed, other in _simplified_token.findall(text):
+        if digits:
+            yield '0'
+        elif letters:
+            yield letters.lower()
+        elif mixed:
+            yield _digits.sub('0', mixed.lower())
+        else:
+            yield other.lower()
+
+
+# Split file in batches of lines
+def _read_chunks(file, size=1024):
+    while True:
+        chunk = list(itertools.islice(file, size))
+        if len(chunk) == 0:
+            break
+        yield chunk
+
+
+# Process batches in a pool of workers, keeping a bounded number of pending batches and preserving order
+def _imap_chunks(function, chunks, processes=None):
+    if processes is None:
+        processes = os.cpu_count()
+    with multiprocessing.Pool(processes) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(function, (chunk,)))
+            if len(pending) >= 4 * processes:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+
+# Normalize batch of raw lines, concatenated as a single encoded output block (along with input size)
+def _normalize_chunk(lines, min_length):
+    result = []
+    for line in lines:
+        
+        # Normalization cannot make ASCII lines longer, hence short ones are skipped right away
+        if len(line) < min_length and line.isascii():
+            continue
+        line = normalize(line.decode('utf-8'))
+        if len(line) >= min_length:
+            result.append(line)
+            result.append('\n')
+    return sum(len(line) for line in lines), ''.join(result).encode('utf-8')
+
+
 # Normalize file
-def to_normalized(input_path, output_path, min_length=100):
-    with io.open(input_path, 'r', newline='\n', encoding='utf-8') as input_file:
-        with io.open(output_path, 'w', newline='\n', encoding='utf-8') as output_file:
-            for line in tqdm(input_file):
-                line = normalize(line)
-                if len(line) >= min_length:
-                    output_file.write(line)
-                    output_file.write('\n')
+def to_normalized(input_path, output_path, min_length=100, processes=None):
+    function = functools.partial(_normalize_chunk, min_length=min_length)
+    with io.open(input_path, 'rb') as input_file:
+        with io.open(output_path, 'wb') as output_file:
+            size = os.fstat(input_file.fileno()).st_size
+            with tqdm(total=size, unit='B', unit_scale=True, mininterval=0.5) as progress:
+                for length, text in _imap_chunks(function, _read_chunks(input_file), processes):
+                    output_file.write(text)
+                    progress.update(length)
+
+
+# Tokenize batch of raw lines, concatenated as a single encoded output block (along with input size)
+def _tokenize_chunk(lines, min_tokens):
+    result = []
+    for line in lines:
+        
+        # There cannot be more tokens than bytes
+        if len(line) < min_tokens:
+            continue
+        tokens = list(tokenize_simplified(line.decode('utf-8')))
+        if len(tokens) >= min_tokens:
+            result.append(' '.join(tokens))
+            result.append('\n')
+    return sum(len(line) for line in lines), ''.join(result).encode('utf-8')
 
 
 # Tokenize file
-def to_tokens(input_path, output_path, min_tokens=10):
-    with io.open(input_path, 'r', newline='\n', encoding='utf-8') as input_file:
-        with io.open(output_path, 'w', newline='\n', encoding='utf-8') as output_file:
-            for line in tqdm(input_file):
-                tokens = []
-                for token, start, end in tokenize(line):
-                    tokens.append(simplify(token))
-                if len(tokens) >= min_tokens:
-                    output_file.write(' '.join(tokens))
-                    output_file.write('\n')
+def to_tokens(input_path, output_path, min_tokens=10, processes=None):
+    function = functools.partial(_tokenize_chunk, min_tokens=min_tokens)
+    with io.open(input_path, 'rb') as input_file:
+        with io.open(output_path, 'wb') as output_file:
+            size = os.fstat(input_file.fileno()).st_size
+            with tqdm(total=size, unit='B', unit_scale=True, mininterval=0.5) as progress:
+                for length, text in _imap_chunks(function, _read_chunks(input_file), processes):
+                    output_file.write(text)
+                    progress.update(length)
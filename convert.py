@@ -4,40 +4,88 @@
 import os
 import io
 import gzip
+import shutil
+import subprocess
+import contextlib
 from lxml import etree
 from tqdm import tqdm
 
 
+# Intel ISA-L provides a faster drop-in replacement for gzip, if installed
+try:
+    from isal import igzip
+except ImportError:
+    igzip = gzip
+
+
+# Open gzipped file for streaming, delegating decompression to pigz if available
+@contextlib.contextmanager
+def open_gzip(path):
+    pigz = shutil.which('pigz')
+    if pigz is None:
+        with igzip.open(path, 'rb') as file:
+            yield file
+        return
+    with io.open(path, 'rb') as file:
+        process = subprocess.Popen([pigz, '-dc'], stdin=file, stdout=subprocess.PIPE, bufsize=1 << 20)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            code = process.wait()
+    if code != 0:
+        raise IOError('pigz failed to decompress %s' % path)
+
+
 # Convert GZipped XML to plain text
 def to_plain_text(input_path, output_path):
     
     # Open archive for streaming
-    with gzip.open(input_path, 'r') as input:
-        content = etree.iterparse(input, events=('start', 'end'))
-        
-        # Acquire root node properties
-        _, root = next(content)
-        assert root.tag == 'wikipedia'
-        lang = root.attrib['lang']
-        count = int(root.attrib['article'])
+    with open_gzip(input_path) as input:
+        content = etree.iterparse(input, events=('end',), huge_tree=True)
         
         # Stream articles
-        with io.open(output_path, 'w', newline='\n', encoding='utf-8') as output:
-            with tqdm(total=count) as progress:
-                for action, element in content:
-                    if action == 'end':
-                        
-                        # Free memory on end of articles and redirections
-                        if element.tag == 'article' or element.tag == 'redirect':
-                            root.clear()
-                            if element.tag == 'article':
-                                progress.update(1)
+        with io.open(output_path, 'wb') as output:
+            with tqdm() as progress:
+                root = None
+                buffer = []
+                buffer_length = 0
+                for _, element in content:
+                    
+                    # Acquire root node properties, once its first child is complete
+                    if root is None:
+                        root = element.getroottree().getroot()
+                        assert root.tag == 'wikipedia'
+                        lang = root.attrib['lang']
+                        progress.total = int(root.attrib['article'])
+                    
+                    # Process paragraph content
+                    if element.tag == 'p':
+                        text = etree.tostring(element, method='text', encoding='unicode', with_tail=False)
+                        buffer.append(text)
+                        buffer.append('\n')
+                        buffer_length += len(text) + 1
+                        if buffer_length >= 1 << 20:
+                            output.write(''.join(buffer).encode('utf-8'))
+                            buffer.clear()
+                            buffer_length = 0
                         
-                        # Process paragraph content
-                        elif element.tag == 'p':
-                            text = ''.join(element.itertext())
-                            output.write(text)
-                            output.write('\n')
+                        # Free it along with its already processed siblings, unless it is part of an enclosing paragraph
+                        if next(element.iterancestors('p'), None) is None:
+                            element.clear()
+                            while element.getprevious() is not None:
+                                del element.getparent()[0]
+                    
+                    # Free memory on end of articles and redirections
+                    elif element.tag == 'article' or element.tag == 'redirect':
+                        element.clear()
+                        while element.getprevious() is not None:
+                            del root[0]
+                        if element.tag == 'article':
+                            progress.update(1)
+                
+                # Flush remaining paragraphs
+                output.write(''.join(buffer).encode('utf-8'))
 
 
 # Standalone usage does the export process
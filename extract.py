@@ -3,13 +3,29 @@
 
 import os
 import io
+import sys
+import struct
+import mmap
 import numpy
 import lzma
-from lxml import etree, html
+from lxml import etree
 import re
 import gzip
+import shutil
+import subprocess
+import contextlib
 from tqdm import tqdm
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Intel ISA-L provides a faster drop-in replacement for gzip, if installed (its levels only range from 0 to 3)
+try:
+    from isal import igzip
+    igzip_max_level = 3
+except ImportError:
+    igzip = gzip
+    igzip_max_level = 9
 
 
 # Keep track of unknown tags, for debug purpose
@@ -17,523 +33,741 @@ unknown_tags = Counter()
 
 
 # Precompile regular expressions used during processing
-r_header = re.compile(r'h([0-9]+)', re.UNICODE)
 r_white = re.compile(r'[ \t\f\r\n\u200B]+', re.UNICODE)
 
 
+# Whitespace characters mapped to a single space, used as a fast path for collapsing
+t_white = str.maketrans('\t\f\r\n\u200B', '     ')
+
+
+# Precompile little-endian binary layouts used in ZIM archives
+s_uint32 = struct.Struct('<I')
+s_header = struct.Struct('<IIQQQQxxxxxxxxQ') # Counts and offsets (up to checksum), located at byte 24
+s_directory = struct.Struct('<HxcxxxxI') # MIME type, namespace and cluster (or redirection) index
+
+
+# Most structural elements are kept as-is
+structural_tags = frozenset({
+    'blockquote',
+    'ul',      # Unordered list container
+    'ol',      # Ordered list container
+    'dl',      # Description list container
+    'li',      # List item
+    'dt',      # Term item
+    'dd'       # Description item
+})
+
+
+# Header are better with their level extracted
+header_levels = {'h1' : 1, 'h2' : 2, 'h3' : 3, 'h4' : 4, 'h5' : 5, 'h6' : 6}
+
+
+# Some structural elements are considered as paragraphs
+paragraph_tags = frozenset({'div', 'p'})
+
+
+# Keep some elements as-is
+kept_tags = frozenset({
+    'cite',    # Reference citation (mostly used for footnotes)
+    'q',       # Inline quotation
+    'sub',     # Subscript
+    'sup'      # Superscript
+})
+
+
+# Code and symbol like are kept under a single mark (to avoid confusion with unexpected content)
+code_tags = frozenset({
+    'code',    # Inline code snippet, usually for variables or short commands
+    'kbd',     # Mark used for keys (can be considered as code)
+    'tt',      # Typescript, usually rendered as monospaced characters
+    'var'      # Variable marker, usually rendered as code
+})
+
+
+# Keep some element as marker, without their content
+marker_tags = frozenset({
+    'br',      # Line-break may be useful
+    'math'     # Math formulas are stripped, for simplicity
+})
+
+
+# Remaining text formatting is stripped
+# TODO maybe should keep some simplified formats (e.g. emphasis)
+stripped_tags = frozenset({
+    'b',       # Bold
+    'bdi',     # Bi-directional isolation, used to handle mixed text orientation (probably useless in this usage)
+    'big',     # Emphasis-like
+    'del',     # Mark for removed/deprecated text, rendered as strikethrough
+    'dfn',     # Emphases, usually rendered as bold
+    'em',      # Emphasis (often rendered as italic)
+    'font',    # Font, mostly used to define text color
+    'i',       # Italic
+    'ins',     # Mark for newly inserted text, usually used for revisions
+    'mark',    # Highlight, usually used for revisions
+    'rb',      # Ruby-related, base marker (this is the only one kept, as it is the actual content)
+    'ruby',    # Ruby is used to annotate glyphs (usually Asian languages)
+    's',       # Strikethrough
+    'section', # Used as container in some language (e.g. latin)
+    'small',   # Emphasis-like
+    'span',    # Generic structure used to apply custom formatting, stripped as it is too complicated too handle
+    'strong',  # Emphasis, usually rendered as bold
+    'u',       # Underline
+    'wbr'      # Word break opportunity, irrelevant for plain text corpora
+})
+
+
+# Some structures are completely ignored
+ignored_tags = frozenset({
+    'audio',   # Embedded audio player
+    'center',  # Centered block (usually used for banners, i.e. don't care)
+    'figure-inline', # ??? (note: occured in latin dump)
+    'hr',      # Horizontal rule (or topic change)
+    'img',     # Embedded image
+    'meta',    # Invisible properties
+    'pre',     # Preserve plain text formatting, usually for code snippet (ignored for simplicity)
+    'rp',      # Ruby-related, fallback parenthesis
+    'rt',      # Ruby-related, pronunciation
+    'rtc',     # Ruby-related, semantic annotation
+    'table'    # Table (removed for simplicity)
+})
+
+
+# HTML parser options, where comments, processing instructions and identifiers are irrelevant
+# Note: blank text is kept, as it may separate inline elements
+# Note: pages are parsed from their main content, hence encoding cannot be detected from their head
+html_parser_options = {
+    'collect_ids' : False,
+    'encoding' : 'utf-8',
+    'huge_tree' : True,
+    'no_network' : True,
+    'remove_comments' : True,
+    'remove_pis' : True
+}
+
+
 # Data placeholder used during processing
 class Node:
+    __slots__ = ('tag', 'level', 'href', 'title', 'datetime')
+    def __init__(self, tag):
+        self.tag = tag
     def __repr__(self):
-        result = dict(vars(self))
-        if 'content' in result:
-            result['content'] = '...'
+        result = {key : getattr(self, key) for key in self.__slots__ if hasattr(self, key)}
         return repr(result)
 
 
-# Recursive decoding of HTML elements
-def decode(element):
-    
-    # Helper to build node
-    def build(tag=None, ignore_element=False, ignore_content=False, **args):
-        if ignore_element:
-            result = []
-            if not ignore_content:
-                if element.text:
-                    result.append(element.text)
-                for child in element.getchildren():
-                    result.extend(decode(child))
-            if element.tail:
-                result.append(element.tail)
-            return result
-        node = Node()
-        node.tag = tag or element.tag
-        for key, value in args.items():
-            setattr(node, key, value)
-        node.content = []
-        if not ignore_content:
-            if element.text:
-                node.content.append(element.text)
-            for child in element.getchildren():
-                node.content.extend(decode(child))
-        result = [node]
-        if element.tail:
-            result.append(element.tail)
-        return result
-    
-    # Ignore weird types
-    if type(element.tag) is str:
-    
-        # Most structural elements are kept as-is
-        if element.tag in {
-            'blockquote',
-            'ul',      # Unordered list container
-            'ol',      # Ordered list container
-            'dl',      # Description list container
-            'li',      # List item
-            'dt',      # Term item
-            'dd'       # Description item
-        }:
-            return build()
-        
-        # Header are better with their level extracted
-        match = r_header.fullmatch(element.tag)
-        if match:
-            return build('h', level = int(match.group(1)))
-        
-        # Some structural elements are considered as paragraphs
-        if element.tag in {'div', 'p'}:
-            return build('p')
-        
-        # Link are kept as-is
-        if element.tag == 'a':
-            return build(href = element.attrib['href'])
-        
-        # Abbreviations are kept, as they might provide useful insights
-        if element.tag == 'abbr':
-            # TODO maybe abbr entities are irrelevant
-            return build(title = element.attrib.get('title', None))
-        
-        # Time markers are kept, as they might provide useful insights
-        if element.tag == 'time':
-            # TODO maybe time entities are irrelevant
-            return build(datetime = element.attrib.get('datetime', None))
-        
-        # Keep some elements as-is
-        if element.tag in {
-            'cite',    # Reference citation (mostly used for footnotes)
-            'q',       # Inline quotation
-            'sub',     # Subscript
-            'sup'      # Superscript
-        }:
-            return build()
-        
-        # Code and symbol like are kept under a single mark (to avoid confusion with unexpected content)
-        if element.tag in {
-            'code',    # Inline code snippet, usually for variables or short commands
-            'kbd',     # Mark used for keys (can be considered as code)
-            'tt',      # Typescript, usually rendered as monospaced characters
-            'var'      # Variable marker, usually rendered as code
-        }:
-            return build('code')
-        
-        # Keep some element as marker, without their content
-        if element.tag in {
-            'br',      # Line-break may be useful
-            'math'     # Math formulas are stripped, for simplicity
-        }:
-            return build(ignore_content=True)
-        
-        # Remaining text formatting is stripped
-        # TODO maybe should keep some simplified formats (e.g. emphasis)
-        if element.tag in {
-            'b',       # Bold
-            'bdi',     # Bi-directional isolation, used to handle mixed text orientation (probably useless in this usage)
-            'big',     # Emphasis-like
-            'del',     # Mark for removed/deprecated text, rendered as strikethrough
-            'dfn',     # Emphases, usually rendered as bold
-            'em',      # Emphasis (often rendered as italic)
-            'font',    # Font, mostly used to define text color
-            'i',       # Italic
-            'ins',     # Mark for newly inserted text, usually used for revisions
-            'mark',    # Highlight, usually used for revisions
-            'rb',      # Ruby-related, base marker (this is the only one kept, as it is the actual content)
-            'ruby',    # Ruby is used to annotate glyphs (usually Asian languages)
-            's',       # Strikethrough
-            'section', # Used as container in some language (e.g. latin)
-            'small',   # Emphasis-like
-            'span',    # Generic structure used to apply custom formatting, stripped as it is too complicated too handle
-            'strong',  # Emphasis, usually rendered as bold
-            'u',       # Underline
-            'wbr'      # Word break opportunity, irrelevant for plain text corpora
-        }:
-            return build(ignore_element=True)
-        
-        # Some structures are completely ignored
-        if element.tag in {
-            'audio',   # Embedded audio player
-            'center',  # Centered block (usually used for banners, i.e. don't care)
-            'figure-inline', # ??? (note: occured in latin dump)
-            'hr',      # Horizontal rule (or topic change)
-            'img',     # Embedded image
-            'meta',    # Invisible properties
-            'pre',     # Preserve plain text formatting, usually for code snippet (ignored for simplicity)
-            'rp',      # Ruby-related, fallback parenthesis
-            'rt',      # Ruby-related, pronunciation
-            'rtc',     # Ruby-related, semantic annotation
-            'table'    # Table (removed for simplicity)
-        }:
-            return build(ignore_element=True, ignore_content=True)
-        
-        # Unknown tags are ignored and reported
-        unknown_tags[element.tag] += 1
-    return build(ignore_element=True, ignore_content=True)
+# Decode element kept as-is
+def decode_kept(element, tag):
+    return Node(tag)
 
 
-# Recursive flattening of decoded nodes, better suited for further processing
-def flatten(content):
-    
-    # Accumulators
-    sequence = []
-    stack = []
-    
-    # Recursive traversal used to flatten the tree
-    def traverse(content):
-        for node in content:
-            if type(node) is Node:
-                
-                # If this is a paragraph...
-                if node.tag == 'p':
-                    
-                    # Close the previous one
-                    if len(stack) > 0:
-                        end = (False, stack[-1])
-                        sequence.append(end)
-                    
-                    # Open the new (nested) one
-                    stack.append(node)
-                    begin = (True, node)
-                    sequence.append(begin)
-                    
-                    # Add children
-                    traverse(node.content)
-                    
-                    # Close it
-                    end = (False, node)
-                    sequence.append(end)
-                    stack.pop()
-                    
-                    # Reopen the previous one
-                    if len(stack) > 0:
-                        begin = (True, stack[-1])
-                        sequence.append(begin)
-                
-                # If this is a structural element...
-                elif node.tag in {'h', 'blockquote', 'ul', 'ol', 'dl', 'li', 'dt', 'dd'}:
-                    
-                    # Close the current paragraph
-                    if len(stack) > 0:
-                        end = (False, stack[-1])
-                        sequence.append(end)
-                    
-                    # Mark the beginning of the group
-                    begin = (True, node)
-                    sequence.append(begin)
-                    
-                    # Reopen the current paragraph
-                    if len(stack) > 0:
-                        begin = (True, stack[-1])
-                        sequence.append(begin)
-                    
-                    # Add children
-                    traverse(node.content)
-                    
-                    # Close the current paragraph again
-                    if len(stack) > 0:
-                        end = (False, stack[-1])
-                        sequence.append(end)
-                    
-                    # Mark the end of the group
-                    end = (False, node)
-                    sequence.append(end)
-                    
-                    # And finally reopen the current paragraph again
-                    if len(stack) > 0:
-                        begin = (True, stack[-1])
-                        sequence.append(begin)
-                
-                # Otherwise, this must be a formatting element...
-                else:
-                    
-                    # Mark the beginning of the group
-                    begin = (True, node)
-                    sequence.append(begin)
-                    
-                    # Add children
-                    traverse(node.content)
-                    
-                    # Mark the end of the group
-                    end = (False, node)
-                    sequence.append(end)
-            
-            # Add text as well
-            else:
-                sequence.append(node)
-    
-    # Process the whole sequence
-    traverse(content)
-    return sequence
+# Decode element considered as paragraph
+def decode_paragraph(element, tag):
+    return Node('p')
+
+
+# Decode header, with its level extracted
+def decode_header(element, tag):
+    node = Node('h')
+    node.level = header_levels[tag]
+    return node
+
+
+# Decode link, kept as-is
+def decode_link(element, tag):
+    node = Node(tag)
+    node.href = element.attrib['href']
+    return node
+
+
+# Decode abbreviation, kept as it might provide useful insights
+# TODO maybe abbr entities are irrelevant
+def decode_abbreviation(element, tag):
+    node = Node(tag)
+    node.title = element.attrib.get('title', None)
+    return node
+
+
+# Decode time marker, kept as it might provide useful insights
+# TODO maybe time entities are irrelevant
+def decode_time(element, tag):
+    node = Node(tag)
+    node.datetime = element.attrib.get('datetime', None)
+    return node
 
 
-# Concatenation and empty node pruning
-def clean(sequence):
+# Decode code and symbol like under a single mark
+def decode_code(element, tag):
+    return Node('code')
+
+
+# Decoding action associated to each known tag, as a kind (i.e. group, marker, strip or ignore) and a node decoder
+tag_actions = {
+    'a' : ('group', decode_link),
+    'abbr' : ('group', decode_abbreviation),
+    'time' : ('group', decode_time)
+}
+tag_actions.update((tag, ('group', decode_kept)) for tag in structural_tags | kept_tags)
+tag_actions.update((tag, ('group', decode_paragraph)) for tag in paragraph_tags)
+tag_actions.update((tag, ('group', decode_header)) for tag in header_levels)
+tag_actions.update((tag, ('group', decode_code)) for tag in code_tags)
+tag_actions.update((tag, ('marker', decode_kept)) for tag in marker_tags)
+tag_actions.update((tag, ('strip', None)) for tag in stripped_tags)
+tag_actions.update((tag, ('ignore', None)) for tag in ignored_tags)
+
+
+# Collapse whitespace sequences into a single space, without regular expression if there is no actual sequence
+def collapse_white(text):
+    result = text.translate(t_white)
+    if '  ' in result:
+        result = r_white.sub(' ', text)
+    return result
+
+
+# Concatenation and empty node pruning, applied on the fly to flattened items
+# TODO remove nested quotes?
+# TODO make sure that list items are in list containers
+# TODO make sure that only list items are in lists
+# TODO check that headers are not in quote or list
+class Cleaner:
     
     # Accumulators
-    result = []
+    def __init__(self):
+        self.result = []
+        self.paragraph = None
+        self.has = False
+        self.parts = []
     
-    # Finalize current paragraph
-    def accept(start, end):
+    # Concatenate text inside current paragraph, if any
+    def text(self, item):
         # TODO this might cause issues for code snippets
-        has = False
-        buffer = ''
-        for i in range(start, end):
-            item = sequence[i]
-            if type(item) is str:
-                buffer += r_white.sub(' ', item)
+        if self.paragraph is not None:
+            self.parts.append(collapse_white(item))
+    
+    # Handle beginning or end of group
+    def mark(self, item):
+        begin, node = item
+        
+        # Isolate paragraphs
+        if node.tag == 'p':
+            if begin:
+                self.paragraph = item
+                self.has = False
+                self.parts.clear()
             else:
-                if not has:
-                    has = True
-                    result.append(sequence[start - 1])
-                    buffer = buffer.lstrip()
-                    if len(buffer) > 0:
-                        result.append(buffer)
-                elif len(buffer) > 0:
-                    result.append(buffer)
-                buffer = ''
-                result.append(item)
-        if has:
+                self.accept(item)
+                self.paragraph = None
+        
+        # Keep the other items as-is
+        elif self.paragraph is None:
+            self.result.append(item)
+        
+        # Formatting inside paragraph means that paragraph is not empty
+        else:
+            buffer = ''.join(self.parts)
+            self.parts.clear()
+            if not self.has:
+                self.has = True
+                self.result.append(self.paragraph)
+                buffer = buffer.lstrip()
+            if len(buffer) > 0:
+                self.result.append(buffer)
+            self.result.append(item)
+    
+    # Finalize current paragraph
+    def accept(self, end):
+        buffer = ''.join(self.parts)
+        self.parts.clear()
+        if self.has:
             buffer = buffer.rstrip()
             if len(buffer) > 0:
-                result.append(buffer)
-            result.append(sequence[end])
+                self.result.append(buffer)
+            self.result.append(end)
         else:
             buffer = buffer.strip()
             if len(buffer) > 0:
-                result.append(sequence[start - 1])
-                result.append(buffer)
-                result.append(sequence[end])
-    
-    # Process the whole sequence...
-    # TODO remove nested quotes?
-    # TODO make sure that list items are in list containers
-    # TODO make sure that only list items are in lists
-    # TODO check that headers are not in quote or list
-    start = None
-    for index, item in enumerate(sequence):
-        if type(item) is tuple:
-            begin, node = item
+                self.result.append(self.paragraph)
+                self.result.append(buffer)
+                self.result.append(end)
+
+
+# Iterative decoding of HTML elements, flattened and cleaned on the fly, better suited for further processing
+def decode(content):
+    
+    # Accumulators, where unknown tags are counted locally and merged once at the end
+    cleaner = Cleaner()
+    text = cleaner.text
+    mark = cleaner.mark
+    unknown = {}
+    
+    # Content is wrapped in a global paragraph
+    root = Node('p')
+    mark((True, root))
+    
+    # Explicit traversal stack, where each level holds the remaining children, the items to emit once they are
+    # exhausted, the tail of the associated element, and the innermost paragraph
+    stack = [(iter((content, )), ((False, root), ), None, root)]
+    while len(stack) > 0:
+        children, closing, tail, paragraph = stack[-1]
+        for element in children:
+            
+            # Ignore weird types, and intern tag names to speed up later comparisons
+            tag = element.tag
+            if type(tag) is not str:
+                if element.tail:
+                    text(element.tail)
+                continue
+            tag = sys.intern(tag)
+            action = tag_actions.get(tag)
             
-            # Isolate paragraphs
+            # Unknown tags are ignored and reported
+            if action is None:
+                unknown[tag] = unknown.get(tag, 0) + 1
+                action = ('ignore', None)
+            kind, decoder = action
+            
+            # Remaining text formatting is stripped, but its content is processed before remaining siblings
+            if kind == 'strip':
+                if element.text:
+                    text(element.text)
+                stack.append((iter(element), (), element.tail, paragraph))
+                break
+            
+            # Some structures are completely ignored
+            if kind == 'ignore':
+                if element.tail:
+                    text(element.tail)
+                continue
+            
+            # Otherwise, create node
+            node = decoder(element, tag)
+            
+            # If this is a paragraph, close the previous one, open the new (nested) one, and prepare to close it and
+            # reopen the previous one
             if node.tag == 'p':
-                if begin:
-                    start = index + 1
-                else:
-                    accept(start, index)
-                    start = None
+                mark((False, paragraph))
+                mark((True, node))
+                node_closing = ((False, node), (True, paragraph))
+                node_paragraph = node
             
-            # And keep the other items as-is
-            elif start is None:
-                result.append(item)
+            # If this is a structural element, mark the beginning of the group while temporarily closing the current
+            # paragraph, and prepare to mark the end of the group in a similar fashion
+            elif node.tag in {'h', 'blockquote', 'ul', 'ol', 'dl', 'li', 'dt', 'dd'}:
+                mark((False, paragraph))
+                mark((True, node))
+                mark((True, paragraph))
+                node_closing = ((False, paragraph), (False, node), (True, paragraph))
+                node_paragraph = paragraph
+            
+            # Otherwise, this must be a formatting element
+            else:
+                mark((True, node))
+                node_closing = ((False, node), )
+                node_paragraph = paragraph
+            
+            # Markers are closed right away, without their content
+            if kind == 'marker':
+                for item in node_closing:
+                    mark(item)
+                if element.tail:
+                    text(element.tail)
+                continue
+            
+            # Otherwise, children are processed before remaining siblings
+            if element.text:
+                text(element.text)
+            stack.append((iter(element), node_closing, element.tail, node_paragraph))
+            break
+        
+        # All children have been processed, close group
+        else:
+            for item in closing:
+                mark(item)
+            if tail:
+                text(tail)
+            stack.pop()
     
-    # Sequence is ready to be encoded
-    return result
+    if len(unknown) > 0:
+        unknown_tags.update(unknown)
+    return cleaner.result
 
 
-# Encode clean sequence into XML tree
-def encode(url, title, sequence):
-    
-    # Pad sequence with global node
-    root = Node()
-    root.tag = 'root'
-    root.title = title
-    root.url = url
-    sequence = [(True, root), *sequence, (False, root)]
+# Create header element
+def build_header(node):
+    return etree.Element('h', level=str(node.level))
+
+
+# Create link element
+def build_link(node):
+    return etree.Element('a', href=node.href)
+
+
+# Create abbreviation element
+def build_abbreviation(node):
+    element = etree.Element('abbr')
+    if node.title:
+        element.attrib['title'] = node.title
+    return element
+
+
+# Create time element
+def build_time(node):
+    element = etree.Element('time')
+    if node.datetime:
+        element.attrib['datetime'] = node.datetime
+    return element
+
+
+# Create element without attribute
+def build_plain(node):
+    return etree.Element(node.tag)
+
+
+# Element builder associated to each encoded tag
+element_builders = {
+    'h' : build_header,
+    'a' : build_link,
+    'abbr' : build_abbreviation,
+    'time' : build_time
+}
+element_builders.update((tag, build_plain) for tag in ('blockquote', 'ul', 'ol', 'dl', 'li', 'dt', 'dd', 'p', 'cite', 'q', 'sub', 'sup', 'code', 'math', 'br'))
+
+
+# Encode clean sequence into XML stream
+def encode(xml_file, url, title, sequence):
     
-    # Recursive generation of XML tree
-    def build(start):
-        
-        # Create node, according to type
-        index = start
-        _, node = sequence[index]
-        if node.tag == 'root':
-            element = etree.Element('article')
-            element.attrib['title'] = node.title
-            element.attrib['url'] = node.url
-        elif node.tag == 'h':
-            element = etree.Element('h')
-            element.attrib['level'] = str(node.level)
-        elif node.tag == 'a':
-            element = etree.Element('a')
-            element.attrib['href'] = node.href
-        elif node.tag == 'abbr':
-            element = etree.Element('abbr')
-            if node.title:
-                element.attrib['title'] = node.title
-        elif node.tag == 'time':
-            element = etree.Element('time')
-            if node.datetime:
-                element.attrib['datetime'] = node.datetime
-        elif node.tag in {'blockquote', 'ul', 'ol', 'dl', 'li', 'dt', 'dd', 'p', 'cite', 'q', 'sub', 'sup', 'code', 'math', 'br'}:
-            element = etree.Element(node.tag)
-        else:
-            raise AssertionError(node.tag)
-        
-        # Add trailing text as node text, if any
-        index += 1
-        if type(sequence[index]) is str:
-            element.text = sequence[index]
-            index += 1
-        
-        # Add following items as children, until end of block is reached
+    # Iterative generation of XML tree, used for each top-level block
+    def build(index):
+        stack = []
         while True:
-            begin, node = sequence[index]
-            if not begin:
-                break
+            item = sequence[index]
+            index += 1
+            
+            # Add text as node text, or as tail of last child
+            if type(item) is str:
+                element = stack[-1]
+                if len(element) > 0:
+                    element[-1].tail = item
+                else:
+                    element.text = item
+                continue
             
-            # Build child
-            child, index = build(index)
+            # Create node, according to type, and register it as child
+            begin, node = item
+            if begin:
+                builder = element_builders.get(node.tag)
+                if builder is None:
+                    raise AssertionError(node.tag)
+                element = builder(node)
+                if len(stack) > 0:
+                    stack[-1].append(element)
+                stack.append(element)
+                continue
             
-            # Add trailing text as child tail, if any
-            if type(sequence[index]) is str:
-                child.tail = sequence[index]
-                index += 1
+            # Otherwise, end of node is reached
+            element = stack.pop()
             
-            # Register child
-            element.append(child)
-        
-        # For headers and description titles, flatten inner paragraph (i.e. a header acts as a paragraph itself)
-        if element.tag in {'h', 'dt'} and len(element) > 0:
-            if len(element) > 1:
-                # TODO handle multiple paragraphs per header/title, i.e. merge them
-                print('WARNING: header/title has more than one paragraph (%s)' % url)
-            paragraph = element[0]
-            element.text = paragraph.text
-            element[:] = paragraph[:]
+            # For headers and description titles, flatten inner paragraph (i.e. a header acts as a paragraph itself)
+            if element.tag in {'h', 'dt'} and len(element) > 0:
+                if len(element) > 1:
+                    # TODO handle multiple paragraphs per header/title, i.e. merge them
+                    print('WARNING: header/title has more than one paragraph (%s)' % url)
+                paragraph = element[0]
+                element.text = paragraph.text
+                element[:] = paragraph[:]
+            
+            # Block is complete
+            if len(stack) == 0:
+                return element, index
+    
+    # Write top-level block, where text-only paragraphs are written without creating any element
+    def write(block):
+        if type(block) is str:
+            with xml_file.element('p'):
+                xml_file.write(block)
+        else:
+            xml_file.write(block)
+    
+    # Write top-level blocks one at a time, keeping the last one pending
+    with xml_file.element('article', attrib={'title' : title, 'url' : url}):
+        pending = None
+        index = 0
+        while index < len(sequence):
+            item = sequence[index]
+            if type(item) is str:
+                if pending is None:
+                    xml_file.write(item)
+                elif type(pending) is str:
+                    write(pending)
+                    xml_file.write(item)
+                    pending = None
+                else:
+                    pending.tail = (pending.tail or '') + item
+                index += 1
+            else:
+                if pending is not None:
+                    write(pending)
+                if item[1].tag == 'p' and type(sequence[index + 1]) is str and not sequence[index + 2][0]:
+                    pending = sequence[index + 1]
+                    index += 3
+                else:
+                    pending, index = build(index)
         
-        # Node is complete
-        return element, index + 1
+        # Hack: remove trailing license notice
+        if type(pending) is str:
+            text = pending
+        elif pending is not None and pending.tag == 'p':
+            text = pending.text
+        else:
+            text = None
+        if pending is not None and not (text and text.startswith('This article is issued from')):
+            write(pending)
+
+
+# HTML pull parser, reused for all articles converted by a process
+content_parser = etree.HTMLPullParser(events=('start', 'end'), tag='div', **html_parser_options)
+
+
+# Stream HTML page until main content is closed, without building the remaining tree
+def find_content(data, chunk_size=1 << 16):
+    
+    # Skip page head and navigation, by starting right at the main content tag (if found)
+    offset = data.find(b'id="mw-content-text"')
+    if offset >= 0:
+        offset = max(data.rfind(b'<', 0, offset), 0)
+    else:
+        offset = 0
     
-    # Generate elements for the whole sequence
-    element, _ = build(0)
+    # Parse page until main content is complete
+    content = None
+    closed = False
+    try:
+        start = offset
+        while not closed and start < len(data):
+            content_parser.feed(data[start : start + chunk_size])
+            start += chunk_size
+            for event, element in content_parser.read_events():
+                if event == 'start':
+                    if content is None and element.get('id') == 'mw-content-text':
+                        content = element
+                elif element is content:
+                    closed = True
+                    break
     
-    # Hack: remove trailing license notice
-    if len(element) > 0 and element[-1].tag == 'p' and element[-1].text and element[-1].text.startswith('This article is issued from'):
-        del element[-1]
+    # Parser must be reset before next page, including pending events
+    finally:
+        content_parser.close()
+        for _ in content_parser.read_events():
+            pass
     
-    # Ready
-    return element
+    # Text following the main content depends on how much data was fed, hence it is always dropped
+    if content is not None:
+        content.tail = None
+    return content
 
 
-# Convert raw HTML bytes into clean XML article
-def parse(url, title, data):
+# Convert raw HTML bytes into clean XML article, written to XML stream
+def parse(xml_file, url, title, data):
     
     # Parse HTML body and extract tree
-    tree = html.fromstring(data)
-    tree = tree.xpath('//div[@id="mw-content-text"]')
-    root = Node()
-    root.tag = 'p'
-    if len(tree) > 0:
-        root.content = decode(tree[0])
+    tree = find_content(data)
+    
+    # Decode structure, flattened and cleaned on the fly
+    if tree is not None:
+        sequence = decode(tree)
+    else:
+        sequence = []
+    
+    # Encode into XML stream
+    encode(xml_file, url, title, sequence)
+
+
+# Read zero-terminated byte string from buffer, along with the offset right after the terminator
+def read_string(buffer, offset):
+    end = buffer.find(b'\x00', offset)
+    if end < 0:
+        end = len(buffer)
+    return buffer[offset:end].decode('utf-8'), end + 1
+
+
+# ZIM archive, as opened by each worker process
+worker_file = None
+
+
+# Open ZIM archive in worker process
+def open_worker_file(input_path):
+    global worker_file
+    worker_file = io.open(input_path, 'rb')
+
+
+# Decompress cluster and write relevant articles as serialized XML (in worker process)
+def process_cluster(output, start, end, blob_indices, urls, titles):
+    
+    # Read whole cluster at once, and prepare decompression according to compression level
+    worker_file.seek(start)
+    data = worker_file.read(end - start)
+    decompressor = None
+    if data[0] == 4:
+        decompressor = lzma.LZMADecompressor()
+        data = decompressor.decompress(memoryview(data)[1:], 4)
     else:
-        root.content = []
+        data = data[1:]
     
-    # Flatten and clean structure
-    sequence = flatten([root])
-    sequence = clean(sequence)
+    # Acquire blob table
+    first_offset, = s_uint32.unpack_from(data, 0)
+    if decompressor is not None:
+        data += decompressor.decompress(b'', first_offset - 4)
+    offsets = numpy.frombuffer(data, '<u4', first_offset // 4)
     
-    # Encode into XML tree
-    tree = encode(url, title, sequence)
-    return tree
+    # Only decompress cluster up to the last relevant blob (blob indices are already sorted)
+    blob_indices = blob_indices.astype(numpy.intp)
+    if decompressor is not None:
+        data += decompressor.decompress(b'', int(offsets[blob_indices[-1] + 1]) - len(data))
+    
+    # Locate all relevant blobs at once
+    blob_starts = offsets[blob_indices].tolist()
+    blob_ends = offsets[blob_indices + 1].tolist()
+    
+    # For each relevant blob, read bytes, then convert and serialize article
+    for url, title, blob_start, blob_end in zip(urls, titles, blob_starts, blob_ends):
+        blob = data[blob_start : blob_end]
+        
+        # Exceptions from lxml cannot be sent back to the main process, hence only their description is kept
+        try:
+            with etree.xmlfile(output, encoding='utf-8') as xml_file:
+                parse(xml_file, url, title, blob)
+        except Exception as e:
+            raise RuntimeError('failed to convert %s: %s' % (url, e))
+        output.write(b'\n')
 
 
-# Read zero-terminated byte string
-def read_string(file):
-    buffer = []
-    while True:
-        byte = file.read(1)
-        if len(byte) == 0 or byte == b'\x00':
-            break
-        buffer.extend(byte)
-    return bytes(buffer).decode('utf-8')
+# Convert a batch of clusters into serialized XML, along with article count and unknown tags (in worker process)
+def process_clusters(clusters):
+    
+    # Unknown tags are collected per batch, to be reported back to the main process
+    unknown_tags.clear()
+    
+    # Convert clusters in order
+    output = io.BytesIO()
+    count = 0
+    for cluster in clusters:
+        process_cluster(output, *cluster)
+        count += len(cluster[3])
+    return output.getvalue(), count, Counter(unknown_tags)
+
+
+# Create gzipped file for streaming, delegating compression to pigz if available
+@contextlib.contextmanager
+def create_gzip(path, level=6):
+    pigz = shutil.which('pigz')
+    if pigz is None:
+        with igzip.open(path, 'wb', compresslevel=min(level, igzip_max_level)) as file:
+            yield file
+        return
+    with io.open(path, 'wb') as file:
+        process = subprocess.Popen([pigz, '-%d' % level, '-c'], stdin=subprocess.PIPE, stdout=file, bufsize=1 << 20)
+        try:
+            yield process.stdin
+        finally:
+            process.stdin.close()
+            code = process.wait()
+    if code != 0:
+        raise IOError('pigz failed to compress %s' % path)
 
 
 # Extract HTML articles and redirections from ZIM archive into a compressed XML file
-def process(input_path, output_path, lang):
+def process(input_path, output_path, lang, compression_level=6, batch_size=64):
     
     # Define little-endian types
-    uint8 = numpy.dtype(numpy.uint8).newbyteorder('<')
-    uint16 = numpy.dtype(numpy.uint16).newbyteorder('<')
-    uint32 = numpy.dtype(numpy.uint32).newbyteorder('<')
     uint64 = numpy.dtype(numpy.uint64).newbyteorder('<')
     
-    # Open file
-    with io.open(input_path, 'rb') as file:
+    # Open file, and map it in memory for random access
+    with io.open(input_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
     
         # Check header
-        magic, = numpy.frombuffer(file.read(4), uint32)
+        magic, = s_uint32.unpack_from(mm, 0)
         if magic != 72173914:
             raise IOError('invalid ZIM file')
     
         # Get counts and offsets
-        file.seek(24)
-        article_count, cluster_count = numpy.frombuffer(file.read(4 * 2), uint32)
-        urls_offset, titles_offset, clusters_offset, mime_types_offset = numpy.frombuffer(file.read(8 * 4), uint64)
+        article_count, cluster_count, urls_offset, titles_offset, clusters_offset, mime_types_offset, checksum_offset = s_header.unpack_from(mm, 24)
     
         # Get MIME types
         mime_types = []
-        file.seek(mime_types_offset)
+        offset = mime_types_offset
         while True:
-            mime_type = read_string(file)
+            mime_type, offset = read_string(mm, offset)
             if len(mime_type) == 0:
                 break
             mime_types.append(mime_type)
     
         # Get directory offsets
-        file.seek(urls_offset)
-        directory_offsets = file.read(8 * article_count)
-        directory_offsets = numpy.frombuffer(directory_offsets, uint64)
-        directory_offsets = numpy.sort(directory_offsets)
-        directory_urls = {}
+        directory_offsets = numpy.frombuffer(mm, uint64, article_count, urls_offset).copy()
+        directory_urls = [None] * article_count
+    
+        # Check MIME type and namespace of all directories at once, using their leading bytes (the view on the
+        # mapped archive must be released, otherwise it cannot be closed)
+        archive_bytes = numpy.frombuffer(mm, numpy.uint8)
+        try:
+            directory_mime_types = archive_bytes[directory_offsets].astype(numpy.uint16) | (archive_bytes[directory_offsets + 1].astype(numpy.uint16) << 8)
+            directory_namespaces = archive_bytes[directory_offsets + 3]
+        finally:
+            del archive_bytes
+        directory_mask = directory_mime_types == 0xffff
+        if 'text/html' in mime_types:
+            directory_mask |= directory_mime_types == mime_types.index('text/html')
+        directory_mask &= directory_namespaces == ord('A')
+    
+        # Relevant directories are visited in storage order, while keeping track of their original index
+        directory_order = numpy.argsort(directory_offsets)
+        directory_order = directory_order[directory_mask[directory_order]]
     
         # For each directory, acquire metadata
         print('Discovering items...')
-        redirect_items = []
-        article_items = []
-        for directory_index in tqdm(range(article_count)):
-            
-            # Check MIME type 
-            file.seek(directory_offsets[directory_index])
-            mime_type, = numpy.frombuffer(file.read(2), uint16)
-            if mime_type == 0xfffe or mime_type == 0xfffd:
-                continue
+        redirect_urls = []
+        redirect_titles = []
+        redirect_targets = numpy.empty(len(directory_order), numpy.uint32)
+        article_urls = []
+        article_titles = []
+        article_clusters = numpy.empty(len(directory_order), numpy.uint32)
+        article_blobs = numpy.empty(len(directory_order), numpy.uint32)
+        for directory_index in tqdm(directory_order.tolist()):
+            offset = int(directory_offsets[directory_index])
+            mime_type, namespace, index = s_directory.unpack_from(mm, offset)
             redirect = mime_type == 0xffff
-            if not redirect:
-                mime_type = mime_types[mime_type]
-                if mime_type != 'text/html':
-                    continue
-            
-            # Check namespace
-            file.seek(1, 1)
-            namespace, = numpy.frombuffer(file.read(1), uint8)
-            namespace = chr(namespace)
-            if namespace != 'A':
-                continue
             
             # Acquire location
-            file.seek(4, 1)
+            offset += s_directory.size
             if redirect:
-                redirect_index, = numpy.frombuffer(file.read(4), uint32)
+                redirect_targets[len(redirect_urls)] = index
             else:
-                cluster_index, blob_index = numpy.frombuffer(file.read(4 * 2), uint32)
-
-            # Acquire name
-            url = read_string(file)
-            title = read_string(file)
+                article_clusters[len(article_urls)] = index
+                article_blobs[len(article_urls)], = s_uint32.unpack_from(mm, offset)
+                offset += 4
             
-            # Register item
+            # Acquire name, and register item
+            url, offset = read_string(mm, offset)
+            title, offset = read_string(mm, offset)
             directory_urls[directory_index] = url
             if redirect:
-                redirect_items.append((url, title, redirect_index))
+                redirect_urls.append(url)
+                redirect_titles.append(title)
             else:
-                article_items.append((url, title, cluster_index, blob_index))
+                article_urls.append(url)
+                article_titles.append(title)
+        
+        # Only keep used part of preallocated arrays
+        redirect_targets = redirect_targets[:len(redirect_urls)]
+        article_clusters = article_clusters[:len(article_urls)]
+        article_blobs = article_blobs[:len(article_urls)]
     
         # Open compressed output file for streaming
-        with etree.xmlfile(output_path, encoding='utf-8', compression=9) as xml_file:
+        with create_gzip(output_path, compression_level) as output, etree.xmlfile(output, encoding='utf-8') as xml_file:
             xml_file.write_declaration()
             
             # Add root node with various information
             attributes = {
-                'article' : str(len(article_items)),
-                'redirect' : str(len(redirect_items)),
+                'article' : str(len(article_urls)),
+                'redirect' : str(len(redirect_urls)),
                 'lang' : lang
             }
             with xml_file.element('wikipedia', attrib=attributes):
@@ -541,7 +775,7 @@ def process(input_path, output_path, lang):
             
                 # Exporting redirections
                 print('Writing redirections...')
-                for url, title, redirect_index in tqdm(redirect_items):
+                for url, title, redirect_index in tqdm(zip(redirect_urls, redirect_titles, redirect_targets.tolist()), total=len(redirect_urls)):
                     node = etree.Element('redirect')
                     node.attrib['url'] = url
                     node.attrib['title'] = title
@@ -549,58 +783,58 @@ def process(input_path, output_path, lang):
                     xml_file.write(node)
                     xml_file.write('\n')
                 
-                # Get cluster offsets
-                file.seek(clusters_offset)
-                cluster_offsets = file.read(8 * cluster_count)
-                cluster_offsets = numpy.frombuffer(cluster_offsets, uint64)
+                # Get cluster offsets (copied, as views would prevent the archive from being closed)
+                cluster_offsets = numpy.frombuffer(mm, uint64, cluster_count, clusters_offset).copy()
+                
+                # Each cluster ends where the next one begins, the last one being followed by the checksum
+                order = numpy.argsort(cluster_offsets)
+                cluster_ends = numpy.empty_like(cluster_offsets)
+                cluster_ends[order] = numpy.append(cluster_offsets[order][1:], numpy.uint64(checksum_offset))
                 
-                # Get cluster list and associated blobs
-                article_items_per_cluster = {}
-                for url, title, cluster_index, blob_index in article_items:
-                    if cluster_index not in article_items_per_cluster:
-                        cluster = []
-                        article_items_per_cluster[cluster_index] = cluster
-                    else:
-                        cluster = article_items_per_cluster[cluster_index]
-                    cluster.append((url, title, blob_index))
+                # Sort articles by cluster offset and blob index, and group them by cluster
+                article_order = numpy.lexsort((article_blobs, cluster_offsets[article_clusters]))
+                article_groups = numpy.split(article_order, numpy.flatnonzero(numpy.diff(article_clusters[article_order])) + 1)
+                if len(article_order) == 0:
+                    article_groups = []
                 
-                # Stream relevant clusters
+                # Articles are serialized by workers, hence pending content must be written before
+                xml_file.flush()
+                
+                # Stream relevant clusters, decoded in parallel but written in order
                 print('Writing articles...')
-                with tqdm(total=len(article_items)) as progress:
-                    for cluster_index in sorted(article_items_per_cluster, key=lambda cluster_index: cluster_offsets[cluster_index]):
-                        
-                        # Jump to cluster and open sub-stream, according to compression level
-                        start = int(cluster_offsets[cluster_index])
-                        file.seek(start)
-                        compression_type, = numpy.frombuffer(file.read(1), uint8)
-                        if compression_type == 4:
-                            subfile = lzma.open(file)
-                            start = 0
-                        else:
-                            subfile = file
-                            start += 4
+                workers = os.cpu_count()
+                with ProcessPoolExecutor(workers, initializer=open_worker_file, initargs=(input_path,)) as executor:
+                    with tqdm(total=len(article_urls)) as progress:
                         
-                        # Acquire blob table
-                        first_offset, = numpy.frombuffer(subfile.read(4), uint32)
-                        blob_count = first_offset // 4
-                        offsets = numpy.empty(blob_count, numpy.int32)
-                        offsets[0] = first_offset
-                        offsets[1:] = numpy.frombuffer(subfile.read(4 * (blob_count - 1)), uint32)
+                        # Write decoded batch, and collect unknown tags reported by worker
+                        def write(future):
+                            data, count, tags = future.result()
+                            output.write(data)
+                            unknown_tags.update(tags)
+                            progress.update(count)
                         
-                        # For each relevant blob, read bytes
-                        for url, title, blob_index in sorted(article_items_per_cluster[cluster_index], key=lambda x: x[2]):
-                            subfile.seek(start + offsets[blob_index])
-                            data = subfile.read(offsets[blob_index + 1] - offsets[blob_index])
+                        # Clusters are sent in batches of a few articles, to amortize communication between processes
+                        pending = deque()
+                        batch = []
+                        batch_count = 0
+                        for group_index, group in enumerate(article_groups):
+                            cluster_index = article_clusters[group[0]]
+                            start = int(cluster_offsets[cluster_index])
+                            end = int(cluster_ends[cluster_index])
+                            urls = [article_urls[i] for i in group.tolist()]
+                            titles = [article_titles[i] for i in group.tolist()]
+                            batch.append((start, end, article_blobs[group], urls, titles))
+                            batch_count += len(urls)
+                            if batch_count >= batch_size or group_index == len(article_groups) - 1:
+                                pending.append(executor.submit(process_clusters, batch))
+                                batch = []
+                                batch_count = 0
                             
-                            # Convert and export article
-                            if b'figure-inline' in data:
-                                with open('foo.xml', 'wb') as f:
-                                    f.write(data)
-                                raise RuntimeError()
-                            node = parse(url, title, data)
-                            xml_file.write(node)
-                            xml_file.write('\n')
-                            progress.update(1)
+                            # Keep a bounded number of batches in flight, to limit memory usage
+                            if len(pending) >= 4 * workers:
+                                write(pending.popleft())
+                        while len(pending) > 0:
+                            write(pending.popleft())
     
     # Report unknown tags
     print('Unknown tags:')
@@ -615,5 +849,6 @@ if __name__ == '__main__':
     parser.add_argument('input', help='ZIM input path')
     parser.add_argument('output', help='Gzipped XML output path')
     parser.add_argument('language', help='language code (en, fr, de, it...)')
+    parser.add_argument('--level', type=int, default=6, choices=range(1, 10), metavar='LEVEL', help='gzip compression level, from 1 to 9 (default: 6)')
     args = parser.parse_args()
-    process(args.input, args.output, args.language)
+    process(args.input, args.output, args.language, args.level)